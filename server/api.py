@@ -2,14 +2,21 @@
 # RAG-Lab Backend API
 # Version ID: 20250827-1220
 
+import json
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from local_llm import create_local_chat_model
+from langchain_openai import ChatOpenAI
+from local_llm import RAG_PROMPT_PREFIX, create_local_chat_model
+from rag.vectorstore import make_embeddings, open_vector_db
 
 # 🔑 Load secrets from .env (never hardcode!)
 load_dotenv()
@@ -40,9 +47,93 @@ class QueryResponse(BaseModel):
     answer: str
     sources: list[str]
 
-# load vector DB once
-embeddings = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
-db = Chroma(persist_directory="db", embedding_function=embeddings)
+# Shared HTTP/2 connection pools for every OpenAI call (chat + embeddings)
+http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+http_client = httpx.Client(limits=http_limits, http2=True)
+http_async_client = httpx.AsyncClient(limits=http_limits, http2=True)
+
+# one embedder shared by every request
+embeddings = make_embeddings(
+    openai_api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=http_client,
+    http_async_client=http_async_client,
+)
+
+# Question -> embedding (LRU), so repeated questions skip the embedder
+query_vectors = OrderedDict()
+QUERY_VECTOR_CACHE_SIZE = 1024
+
+async def embed_question(question: str):
+    """Embed a question, reusing the vector of a recently seen identical question"""
+    vector = query_vectors.get(question)
+    if vector is None:
+        vector = await embeddings.aembed_query(question)
+        query_vectors[question] = vector
+        if len(query_vectors) > QUERY_VECTOR_CACHE_SIZE:
+            query_vectors.popitem(last=False)
+    else:
+        query_vectors.move_to_end(question)
+    return vector
+
+# Vector DB (HNSW-indexed Chroma, opened once)
+vector_db = None
+
+def get_vector_db():
+    """Get or open the vector store (cached)"""
+    global vector_db
+    if vector_db is None:
+        vector_db = open_vector_db(embeddings)
+    return vector_db
+
+class SemanticCache:
+    """In-process answer cache: exact question hits first, then cosine-similar questions"""
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # (model, k, question) -> (expires_at, unit vector, response)
+
+    def get_exact(self, key):
+        """Answer cached for exactly this (model, k, question), if still fresh"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[2]
+
+    def get_similar(self, key, vector):
+        """Answer cached for the most similar question with the same model and k"""
+        now = time.monotonic()
+        candidates = [
+            entry for cached_key, entry in self.entries.items()
+            if cached_key[:2] == key[:2] and entry[0] >= now
+        ]
+        if not candidates:
+            return None
+
+        scores = np.stack([entry[1] for entry in candidates]) @ self._unit(vector)
+        best = int(np.argmax(scores))
+        return candidates[best][2] if scores[best] >= self.threshold else None
+
+    def put(self, key, vector, response):
+        now = time.monotonic()
+        if len(self.entries) >= self.max_entries:
+            # Drop expired entries, then the oldest ones if still full
+            self.entries = {k: e for k, e in self.entries.items() if e[0] >= now}
+            while len(self.entries) >= self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+        self.entries[key] = (now + self.ttl, self._unit(vector), response)
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+def canonical_question(question: str) -> str:
+    """Normalize case and whitespace so trivially different questions share a cache key"""
+    return " ".join(question.lower().split())
+
+answer_cache = SemanticCache()
 
 # Initialize local models (cached)
 local_models = {}
@@ -51,42 +142,162 @@ def get_local_model(model_name: str):
     """Get or create a local model instance (cached)"""
     if model_name not in local_models:
         if model_name == "local-gpt2":
-            local_models[model_name] = create_local_chat_model("gpt2")
+            local_models[model_name] = create_local_chat_model("gpt2", executor=app.state.pool)
         elif model_name == "local-distilgpt2":
-            local_models[model_name] = create_local_chat_model("distilgpt2")
+            local_models[model_name] = create_local_chat_model("distilgpt2", executor=app.state.pool)
         else:
             raise ValueError(f"Unknown local model: {model_name}")
     return local_models[model_name]
 
+# OpenAI chat clients (cached, all sharing the HTTP connection pools above)
+chat_models = {}
+
+def get_chat_model(model_name: str):
+    """Get or create a ChatOpenAI client for model_name (cached)"""
+    if model_name not in chat_models:
+        chat_models[model_name] = ChatOpenAI(
+            model=model_name,
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    return chat_models[model_name]
+
+@app.on_event("startup")
+async def create_inference_pool():
+    """Thread pool for blocking local generate calls (1 worker avoids GIL/CUDA contention)"""
+    app.state.pool = ThreadPoolExecutor(max_workers=int(os.getenv("LOCAL_LLM_WORKERS", "1")))
+
+@app.on_event("startup")
+async def warm_up():
+    """Open the vector DB, load local models and run warmup calls before accepting traffic (fails fast)"""
+    get_vector_db()
+    await embeddings.aembed_query("warmup")
+
+    preload = os.getenv("RAG_PRELOAD_MODELS", "local-gpt2,local-distilgpt2")
+    for model_name in filter(None, (m.strip() for m in preload.split(","))):
+        # Local models report generation failures as "Error: ..." content instead of raising
+        result = await get_local_model(model_name).ainvoke("warmup")
+        if result.content.startswith("Error:"):
+            raise RuntimeError(f"Warmup of {model_name} failed: {result.content}")
+
+@app.on_event("shutdown")
+async def stop_local_batchers():
+    """Stop the micro-batching workers of any loaded local models and close HTTP pools"""
+    for model in local_models.values():
+        await model.stop_batcher()
+    app.state.pool.shutdown(wait=False)
+    await http_async_client.aclose()
+    http_client.close()
+
+def join_prompt(head: str, docs, tail: str) -> str:
+    """head + doc contents (blank-line separated) + tail, copied once with no intermediate context string"""
+    parts = [head]
+    for i, d in enumerate(docs):
+        if i:
+            parts.append("\n\n")
+        parts.append(d.page_content)
+    parts.append(tail)
+    return "".join(parts)
+
+def select_llm_and_prompt(req: QueryRequest, docs):
+    """Choose model - OpenAI or local - and build its RAG prompt from the retrieved docs"""
+    if req.model.startswith("local-"):
+        # Use local model
+        llm = get_local_model(req.model)
+        # Static prefix + dynamic body; the model reuses the prefix's cached token IDs
+        prompt = join_prompt(RAG_PROMPT_PREFIX, docs, f"\n\nQuestion: {req.question}\n\nAnswer:")
+    else:
+        # Use OpenAI model
+        llm = get_chat_model(req.model)
+        prompt = join_prompt("Use the following context to answer:\n\n", docs, f"\n\nQ: {req.question}\nA:")
+    return llm, prompt
+
+def doc_sources(docs) -> list[str]:
+    """Source file of each doc, plus other files holding the same chunk (deduplicated at ingest)"""
+    sources = []
+    for d in docs:
+        sources.append(d.metadata.get("source", "Unknown"))
+        sources.extend(s for s in d.metadata.get("also_in", "").split(",") if s)
+    return sources
+
+def sse_event(data: str, event: str = None) -> str:
+    """Format one Server-Sent Event (multi-line data is split across data: fields)"""
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
 @app.post("/query", response_model=QueryResponse)
 async def query_rag(req: QueryRequest):
     """RAG query endpoint."""
 
-    docs = db.similarity_search(req.question, k=req.k)
+    # Identical questions skip embedding, retrieval and generation entirely
+    cache_key = (req.model, req.k, canonical_question(req.question))
+    cached = answer_cache.get_exact(cache_key)
+    if cached is not None:
+        return cached
+
+    # Paraphrased questions skip retrieval and generation
+    question_vector = await embed_question(req.question)
+    cached = answer_cache.get_similar(cache_key, question_vector)
+    if cached is not None:
+        return cached
+
+    docs = get_vector_db().similarity_search_by_vector(question_vector, k=req.k)
     if not docs:
         return QueryResponse(
             answer="⚠️ No relevant context found in vector store.",
             sources=[]
         )
 
-    context = "\n\n".join([d.page_content for d in docs])
+    # Concurrent local queries are micro-batched into one generate call on app.state.pool
+    llm, prompt = select_llm_and_prompt(req, docs)
+    result = await llm.ainvoke(prompt)
 
-    # Choose model - OpenAI or local
-    if req.model.startswith("local-"):
-        # Use local model
-        llm = get_local_model(req.model)
-        prompt = f"Based on the following context, answer the question concisely:\n\nContext:\n{context}\n\nQuestion: {req.question}\n\nAnswer:"
-    else:
-        # Use OpenAI model
-        llm = ChatOpenAI(model=req.model, openai_api_key=os.getenv("OPENAI_API_KEY"))
-        prompt = f"Use the following context to answer:\n\n{context}\n\nQ: {req.question}\nA:"
-    
-    result = llm.invoke(prompt)
-
-    return QueryResponse(
+    response = QueryResponse(
         answer=result.content,
-        sources=[d.metadata.get("source", "Unknown") for d in docs]
+        sources=doc_sources(docs)
     )
+    if not result.content.startswith("Error:"):
+        answer_cache.put(cache_key, question_vector, response)
+    return response
+
+@app.post("/query/stream")
+async def query_rag_stream(req: QueryRequest):
+    """RAG query endpoint streaming the answer as Server-Sent Events, then a "sources" event
+    (or an "error" event if generation fails after the response has started)."""
+
+    cache_key = (req.model, req.k, canonical_question(req.question))
+    cached = answer_cache.get_exact(cache_key)
+    docs = []
+    if cached is None:
+        question_vector = await embed_question(req.question)
+        cached = answer_cache.get_similar(cache_key, question_vector)
+    if cached is None:
+        docs = get_vector_db().similarity_search_by_vector(question_vector, k=req.k)
+
+    async def events():
+        if cached is not None:
+            # Cached answers arrive in one piece
+            yield sse_event(cached.answer)
+            sources = cached.sources
+        elif not docs:
+            yield sse_event("⚠️ No relevant context found in vector store.")
+            sources = []
+        else:
+            llm, prompt = select_llm_and_prompt(req, docs)
+            try:
+                async for chunk in llm.astream(prompt):
+                    if chunk.content:
+                        yield sse_event(chunk.content)
+            except Exception as e:
+                # Headers are already sent, so report the failure in-band like /query's "Error: ..."
+                yield sse_event(f"Error: {e}", event="error")
+                return
+            sources = doc_sources(docs)
+        yield sse_event(json.dumps(sources), event="sources")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 @app.get("/health")
 async def health_check():
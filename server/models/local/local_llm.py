@@ -3,27 +3,68 @@
 Local LLM wrapper compatible with langchain ChatOpenAI interface
 Replaces OpenAI API calls with local model inference
 """
+import asyncio
+import importlib.util
+import os
+import re
+from concurrent.futures import Executor
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, TextIteratorStreamer
+from transformers.pytorch_utils import Conv1D
 from langchain_core.messages import BaseMessage, HumanMessage
 from langchain_core.language_models.llms import LLM
-from typing import Any, List, Optional
+from typing import Any, AsyncIterator, List, Optional
+from uuid import uuid4
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Post-processing patterns for _clean_response
+_QUESTION_PATTERNS = ("Question:", "Q:")
+_LAST_PUNCT_RE = re.compile(r"[.!?](?=[^.!?]*$)")  # last sentence-ending punctuation
+
+# Static head of the RAG prompt built in api.py; its token IDs are computed once per model
+RAG_PROMPT_PREFIX = "Based on the following context, answer the question concisely:\n\nContext:\n"
+
+def conv1d_to_linear(model):
+    """Swap GPT-2's Conv1D layers for equivalent nn.Linear so dynamic quantization can reach them"""
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                # Conv1D computes x @ W + b with W shaped (in, out); Linear stores W transposed
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
 class LocalChatModel:
     """
     Local model wrapper that mimics ChatOpenAI interface
     """
     
-    def __init__(self, model_name: str = "gpt2", max_new_tokens: int = 150, temperature: float = 0.7, max_input_length: int = 400):
+    def __init__(self, model_name: str = "gpt2", max_new_tokens: int = 150, temperature: float = 0.7, max_input_length: int = 400,
+                 max_batch_size: int = 8, batch_wait_ms: float = 10.0, backend: Optional[str] = None,
+                 quantize: bool = True, compile_model: bool = True, executor: Optional[Executor] = None):
         self.model_name = model_name
+        self.backend = backend or os.getenv("LOCAL_LLM_BACKEND", "hf")  # "hf" (transformers) or "vllm"
         self.max_new_tokens = max_new_tokens
         self.temperature = temperature
         self.max_input_length = max_input_length  # Limit input to prevent context overflow
+        self.quantize = quantize  # INT8 weights (bitsandbytes on GPU, dynamic quantization on CPU)
+        self.compile_model = compile_model  # torch.compile the forward pass on GPU
+        self.max_batch_size = max_batch_size  # Max prompts coalesced into one generate call
+        self.batch_wait = batch_wait_ms / 1000  # How long to wait for more prompts to join a batch
+        self.executor = executor  # Where batched generate runs, keeping it off the event loop
         self.model = None
         self.tokenizer = None
+        self.device = None  # Device of the model's weights (inputs are moved here)
+        self.engine = None  # vLLM AsyncLLMEngine when backend == "vllm"
+        self._prefix_ids = None  # Cached token IDs of RAG_PROMPT_PREFIX
+        
+        # Micro-batching state (created on first use inside the event loop)
+        self._queue = None
+        self._batch_task = None
         
         self._load_model()
     
@@ -35,20 +76,52 @@ class LocalChatModel:
             # Load tokenizer
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
             self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Left-pad so every row in a batch ends right where generation starts
+            self.tokenizer.padding_side = "left"
+            self._prefix_ids = self.tokenizer(RAG_PROMPT_PREFIX)["input_ids"]
             
-            # Load model with optimizations
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                low_cpu_mem_usage=True,
-            )
+            # vLLM does its own continuous batching, so the HF model is not needed
+            if self.backend == "vllm" and self._load_vllm_engine():
+                logger.info(f"✅ Local model {self.model_name} loaded on vLLM engine")
+                return
             
-            # Move to GPU if available
-            if torch.cuda.is_available():
-                self.model = self.model.cuda()
-                logger.info("Model loaded on GPU")
+            if torch.cuda.is_available() and self.quantize and importlib.util.find_spec("bitsandbytes"):
+                # INT8 weights via bitsandbytes; device_map places the model, so no .cuda() move
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                    device_map="auto",
+                    attn_implementation=self._attn_implementation(),
+                    low_cpu_mem_usage=True,
+                )
+                logger.info("Model loaded on GPU (int8)")
             else:
-                logger.info("Model loaded on CPU")
+                # Load model with optimizations
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+                    low_cpu_mem_usage=True,
+                    attn_implementation=self._attn_implementation(),
+                )
+                
+                # Move to GPU if available
+                if torch.cuda.is_available():
+                    self.model = self.model.cuda()
+                    logger.info("Model loaded on GPU")
+                elif self.quantize:
+                    # CPU decode is memory-bandwidth bound: INT8 Linear layers halve/quarter weight traffic
+                    self.model = torch.ao.quantization.quantize_dynamic(
+                        conv1d_to_linear(self.model), {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                    logger.info("Model loaded on CPU (dynamic int8)")
+                else:
+                    logger.info("Model loaded on CPU")
+            
+            # Resolved once; works for device_map placement and quantized models alike
+            self.device = next(self.model.parameters()).device
+            
+            if self.compile_model and torch.cuda.is_available():
+                self._compile_forward()
                 
             logger.info(f"✅ Local model {self.model_name} loaded successfully")
             
@@ -56,81 +129,282 @@ class LocalChatModel:
             logger.error(f"Failed to load model {self.model_name}: {e}")
             raise
     
+    def _attn_implementation(self) -> str:
+        """Fused attention kernel: FlashAttention-2 on CUDA when installed, else PyTorch SDPA"""
+        if torch.cuda.is_available() and importlib.util.find_spec("flash_attn"):
+            return "flash_attention_2"
+        return "sdpa"
+    
+    def _compile_forward(self):
+        """Compile the per-step forward with dynamic shapes (fused Inductor kernels) and warm it up before serving"""
+        eager_forward = self.model.forward
+        # No CUDA graphs (reduce-overhead): GPT-2's legacy tuple KV cache grows by one position per
+        # decode step, so every (batch, length) pair would record its own graph. dynamic=True compiles
+        # the batch and sequence dims symbolically, so a few graphs (prefill, decode) serve every step
+        self.model.forward = torch.compile(eager_forward, dynamic=True, fullgraph=False)
+        
+        try:
+            # Dynamo specializes size-1 dims, so warm up a single prompt and a full micro-batch;
+            # two new tokens cover the prefill and the (growing-cache) decode step
+            for batch_size in sorted({1, self.max_batch_size}):
+                input_ids = torch.full((batch_size, 8), self.tokenizer.eos_token_id, device=self.device)
+                with torch.inference_mode():
+                    self.model.generate(
+                        input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        max_new_tokens=2,
+                        pad_token_id=self.tokenizer.eos_token_id
+                    )
+            logger.info("Model forward compiled")
+        except Exception as e:
+            logger.warning(f"torch.compile failed, using eager forward: {e}")
+            self.model.forward = eager_forward
+    
+    def _load_vllm_engine(self) -> bool:
+        """Start a vLLM AsyncLLMEngine (continuous batching + PagedAttention); False if vLLM is unavailable"""
+        try:
+            from vllm import AsyncEngineArgs, AsyncLLMEngine
+        except ImportError:
+            logger.warning("vLLM is not installed, falling back to transformers backend")
+            self.backend = "hf"
+            return False
+        
+        # Each engine reserves this fraction of GPU memory up front; the default leaves room for
+        # the two models api.py preloads (vLLM's own default of 0.9 would OOM the second one)
+        self.engine = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(
+                model=self.model_name,
+                dtype="float16",
+                max_model_len=512,
+                gpu_memory_utilization=float(os.getenv("VLLM_GPU_MEMORY_UTILIZATION", "0.4")),
+            )
+        )
+        return True
+    
     def invoke(self, prompt: str) -> "LocalChatResponse":
         """
         Generate response for a given prompt (compatible with ChatOpenAI.invoke)
         """
+        if self.engine is not None:
+            raise RuntimeError("vLLM backend is async-only, use ainvoke()")
+        
         try:
-            # Clean and prepare prompt
-            if isinstance(prompt, (list, tuple)):
-                # Handle message format
-                prompt_text = prompt[0] if len(prompt) > 0 else ""
-            else:
-                prompt_text = str(prompt)
-            
-            # Truncate prompt if too long (preserve the question at the end)
-            if len(prompt_text) > self.max_input_length:
-                # Try to keep the question by finding it after "Question:" or "Q:"
-                question_markers = ["Question:", "Q:"]
-                question_start = -1
-                
-                for marker in question_markers:
-                    pos = prompt_text.rfind(marker)
-                    if pos != -1:
-                        question_start = pos
-                        break
-                
-                if question_start != -1 and question_start > self.max_input_length // 2:
-                    # Keep some context + the question
-                    context_budget = self.max_input_length - (len(prompt_text) - question_start)
-                    if context_budget > 50:  # Minimum context
-                        prompt_text = prompt_text[:context_budget] + "..." + prompt_text[question_start:]
-                    else:
-                        # Just keep the question part
-                        prompt_text = prompt_text[question_start:]
-                else:
-                    # Simple truncation
-                    prompt_text = prompt_text[:self.max_input_length] + "..."
+            return self._generate_batch([self._prepare_prompt(prompt)])[0]
+        except Exception as e:
+            logger.error(f"Generation failed: {e}")
+            return LocalChatResponse(content=f"Error: {str(e)}")
+    
+    async def ainvoke(self, prompt: str) -> "LocalChatResponse":
+        """
+        Async generate (compatible with ChatOpenAI.ainvoke).
+        Prompts arriving within batch_wait of each other share one generate call.
+        """
+        if self.engine is not None:
+            return await self._vllm_generate(self._prepare_prompt(prompt))
+        
+        if self._batch_task is None:
+            self.start_batcher()
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((self._prepare_prompt(prompt), future))
+        return await future
+    
+    async def _vllm_generate(self, prompt_text: str) -> "LocalChatResponse":
+        """Generate through the vLLM engine, which schedules concurrent requests itself"""
+        from vllm import SamplingParams
+        
+        try:
+            params = SamplingParams(temperature=self.temperature, max_tokens=self.max_new_tokens)
+            final = None
+            async for output in self.engine.generate(prompt_text, params, request_id=uuid4().hex):
+                final = output
             
-            # Tokenize input
-            inputs = self.tokenizer(
-                prompt_text, 
-                return_tensors="pt", 
-                max_length=512, 
-                truncation=True,
-                padding=True
-            )
+            return LocalChatResponse(content=self._clean_response(final.outputs[0].text.strip()))
+        except Exception as e:
+            logger.error(f"Generation failed: {e}")
+            return LocalChatResponse(content=f"Error: {str(e)}")
+    
+    async def astream(self, prompt: str) -> AsyncIterator["LocalChatResponse"]:
+        """
+        Yield the response as it is generated (compatible with ChatOpenAI.astream).
+        Streamed text skips _clean_response, which needs the whole response.
+        """
+        prompt_text = self._prepare_prompt(prompt)
+        
+        if self.engine is not None:
+            from vllm import SamplingParams
             
-            # Move to same device as model
-            if torch.cuda.is_available() and self.model.device.type == 'cuda':
-                inputs = {k: v.cuda() for k, v in inputs.items()}
+            # vLLM yields the cumulative text so far; emit only the new part
+            params = SamplingParams(temperature=self.temperature, max_tokens=self.max_new_tokens)
+            sent = 0
+            async for output in self.engine.generate(prompt_text, params, request_id=uuid4().hex):
+                text = output.outputs[0].text
+                yield LocalChatResponse(content=text[sent:])
+                sent = len(text)
+            return
+        
+        inputs = self._encode([prompt_text])
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        
+        def generate():
+            try:
+                with torch.inference_mode():
+                    self.model.generate(
+                        inputs["input_ids"],
+                        attention_mask=inputs["attention_mask"],
+                        max_new_tokens=self.max_new_tokens,
+                        temperature=self.temperature,
+                        do_sample=True,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        eos_token_id=self.tokenizer.eos_token_id,
+                        streamer=streamer
+                    )
+            except Exception as e:
+                logger.error(f"Streaming generation failed: {e}")
+                streamer.end()  # Unblock the consumer, then fail the stream below
+                raise
+        
+        loop = asyncio.get_running_loop()
+        generation = loop.run_in_executor(self.executor, generate)
+        
+        # The streamer blocks on a queue, so pull each piece off the event loop
+        pieces = iter(streamer)
+        while True:
+            piece = await asyncio.to_thread(next, pieces, None)
+            if piece is None:
+                break
+            yield LocalChatResponse(content=piece)
+        await generation  # Re-raises a generation failure instead of ending the stream as if it succeeded
+    
+    def start_batcher(self):
+        """Start the background micro-batching worker (must be called inside a running event loop)"""
+        if self._batch_task is None:
+            self._queue = asyncio.Queue()
+            self._batch_task = asyncio.get_running_loop().create_task(self._batch_worker())
+    
+    async def stop_batcher(self):
+        """Cancel the background micro-batching worker"""
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+            self._queue = None
+    
+    async def _batch_worker(self):
+        """Drain the queue into batches of up to max_batch_size prompts and resolve their futures"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            # Block for the first prompt, then give others a short window to join
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
             
-            # Generate response
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs.input_ids,
-                    attention_mask=inputs.attention_mask,
-                    max_new_tokens=self.max_new_tokens,
-                    temperature=self.temperature,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id
-                )
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
             
-            # Decode response
-            full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+            prompt_texts = [prompt_text for prompt_text, _ in batch]
+            try:
+                # Prompts keep queueing while this runs, so the next batch grows under load
+                responses = await loop.run_in_executor(self.executor, self._generate_batch, prompt_texts)
+            except Exception as e:
+                logger.error(f"Batched generation failed: {e}")
+                responses = [LocalChatResponse(content=f"Error: {str(e)}")] * len(batch)
             
-            # Extract only the new content (after the prompt)
-            response_text = full_response[len(prompt_text):].strip()
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+    
+    def _prepare_prompt(self, prompt) -> str:
+        """Normalize the prompt to text and truncate it to max_input_length"""
+        # Clean and prepare prompt
+        if isinstance(prompt, (list, tuple)):
+            # Handle message format
+            prompt_text = prompt[0] if len(prompt) > 0 else ""
+        else:
+            prompt_text = str(prompt)
+        
+        # Truncate prompt if too long (preserve the question at the end)
+        if len(prompt_text) > self.max_input_length:
+            # Try to keep the question by finding it after "Question:" or "Q:"
+            question_markers = ["Question:", "Q:"]
+            question_start = -1
             
-            # Clean up response
-            response_text = self._clean_response(response_text)
+            for marker in question_markers:
+                pos = prompt_text.rfind(marker)
+                if pos != -1:
+                    question_start = pos
+                    break
             
-            return LocalChatResponse(content=response_text)
+            if question_start != -1 and question_start > self.max_input_length // 2:
+                # Keep some context + the question
+                context_budget = self.max_input_length - (len(prompt_text) - question_start)
+                if context_budget > 50:  # Minimum context
+                    prompt_text = prompt_text[:context_budget] + "..." + prompt_text[question_start:]
+                else:
+                    # Just keep the question part
+                    prompt_text = prompt_text[question_start:]
+            else:
+                # Simple truncation
+                prompt_text = prompt_text[:self.max_input_length] + "..."
+        
+        return prompt_text
+    
+    def _encode(self, prompt_texts: List[str], max_length: int = 512):
+        """Tokenize prompts, reusing the cached RAG prefix IDs so only the dynamic part is tokenized"""
+        prefix_len = len(RAG_PROMPT_PREFIX)
+        has_prefix = [text.startswith(RAG_PROMPT_PREFIX) for text in prompt_texts]
+        bodies = [text[prefix_len:] if cached else text for text, cached in zip(prompt_texts, has_prefix)]
+        
+        rows = []
+        for ids, cached in zip(self.tokenizer(bodies)["input_ids"], has_prefix):
+            if cached:
+                ids = self._prefix_ids + ids
+            rows.append(ids[:max_length])
+        
+        inputs = self.tokenizer.pad({"input_ids": rows}, padding=True, return_tensors="pt")
+        
+        # Move to same device as model (no-op on CPU)
+        inputs = {k: v.to(self.device, non_blocking=True) for k, v in inputs.items()}
+        
+        return inputs
+    
+    def _generate_batch(self, prompt_texts: List[str]) -> List["LocalChatResponse"]:
+        """Run one padded generate call over all prompts and return one response per prompt"""
+        # Tokenize input (left-padded to the longest prompt in the batch)
+        inputs = self._encode(prompt_texts)
+        
+        # Generate response
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_new_tokens=self.max_new_tokens,
+                temperature=self.temperature,
+                do_sample=True,
+                pad_token_id=self.tokenizer.eos_token_id,
+                eos_token_id=self.tokenizer.eos_token_id
+            )
+        
+        # Every row is left-padded to the same input length, so new tokens start there
+        input_length = inputs["input_ids"].shape[1]
+        responses = []
+        for row in outputs:
+            # Decode only the new content (after the prompt)
+            response_text = self.tokenizer.decode(row[input_length:], skip_special_tokens=True).strip()
             
-        except Exception as e:
-            logger.error(f"Generation failed: {e}")
-            return LocalChatResponse(content=f"Error: {str(e)}")
+            # Clean up response
+            responses.append(LocalChatResponse(content=self._clean_response(response_text)))
+        
+        return responses
     
     def _clean_response(self, response: str) -> str:
         """Clean up the generated response"""
@@ -144,43 +418,42 @@ class LocalChatModel:
         
         for line in lines:
             line = line.strip()
-            if line and line not in seen_lines:
-                unique_lines.append(line)
-                seen_lines.add(line)
-            elif line and len(unique_lines) > 0:
+            if not line:
+                continue
+            # add() doubles as the membership test: one hash-table probe per line
+            seen_count = len(seen_lines)
+            seen_lines.add(line)
+            if len(seen_lines) == seen_count:
                 # Stop at first repetition
                 break
+            unique_lines.append(line)
         
         response = '\n'.join(unique_lines)
         
         # Remove repeated question patterns
-        question_patterns = ["Question:", "Q:"]
-        for pattern in question_patterns:
-            if response.count(pattern) > 1:
-                # Keep only content before the second occurrence
-                parts = response.split(pattern)
+        for pattern in _QUESTION_PATTERNS:
+            # maxsplit=2 stops scanning once a second occurrence is found
+            parts = response.split(pattern, 2)
+            if len(parts) > 2:
+                # Keep only content before the first occurrence
                 response = parts[0].strip()
                 break
         
         # Stop at natural break points if response is too long
         if len(response) > 400:
             # Try to cut at sentence boundary
-            sentences = response.split('. ')
-            if len(sentences) > 1:
-                response = '. '.join(sentences[:-1]) + '.'
+            last_sentence = response.rfind('. ')
+            if last_sentence != -1:
+                response = response[:last_sentence] + '.'
         
         # Remove incomplete sentences at the end
         if response and not response.endswith(('.', '!', '?', ':')):
-            words = response.split()
-            if len(words) > 3:  # Keep response if it's reasonably long
+            if len(response.split(maxsplit=3)) > 3:  # Keep response if it's reasonably long (4+ words)
                 # Find last complete sentence
-                last_period = response.rfind('.')
-                last_excl = response.rfind('!')
-                last_quest = response.rfind('?')
-                last_punct = max(last_period, last_excl, last_quest)
+                match = _LAST_PUNCT_RE.search(response)
                 
-                if last_punct > len(response) * 0.4:  # If we find punctuation in latter part
-                    response = response[:last_punct + 1]
+                if match and match.start() > len(response) * 0.4:  # If we find punctuation in latter part
+                    response = response[:match.start() + 1]
         
         return response
 
@@ -191,9 +464,10 @@ class LocalChatResponse:
         self.content = content
 
 
-def create_local_chat_model(model_name: str = "gpt2") -> LocalChatModel:
+def create_local_chat_model(model_name: str = "gpt2", backend: Optional[str] = None,
+                            executor: Optional[Executor] = None) -> LocalChatModel:
     """Factory function to create a local chat model"""
-    return LocalChatModel(model_name=model_name)
+    return LocalChatModel(model_name=model_name, backend=backend, executor=executor)
 
 
 # Test function
@@ -3,6 +3,7 @@
 Test with a proven small model for RAG - GPT-2 or DialoGPT
 """
 from transformers import AutoTokenizer, AutoModelForCausalLM
+from local_llm import conv1d_to_linear
 import torch
 import time
 
@@ -18,15 +19,17 @@ def test_gpt2_small():
         tokenizer.pad_token = tokenizer.eos_token
         print("✅ Tokenizer loaded")
         
-        # Load model
+        # Load model (FP32 so the Linear layers can be dynamically quantized to INT8 on CPU)
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
-            torch_dtype=torch.float16,
+            torch_dtype=torch.float32,
             low_cpu_mem_usage=True
         )
+        # Count before quantizing: packed INT8 Linear weights are no longer nn.Parameters
+        param_count = sum(p.numel() for p in model.parameters()) / 1e6
+        model = torch.ao.quantization.quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
         
         load_time = time.time() - start_time
-        param_count = sum(p.numel() for p in model.parameters()) / 1e6
         print(f"✅ Model loaded in {load_time:.1f}s")
         print(f"📊 Parameters: {param_count:.1f}M")
         
@@ -81,9 +84,10 @@ def test_distilgpt2():
         tokenizer.pad_token = tokenizer.eos_token
         
         model = AutoModelForCausalLM.from_pretrained(model_name)
+        param_count = sum(p.numel() for p in model.parameters()) / 1e6  # before INT8 packing hides the Linear weights
+        model = torch.ao.quantization.quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
         
         load_time = time.time() - start_time
-        param_count = sum(p.numel() for p in model.parameters()) / 1e6
         print(f"✅ DistilGPT-2 loaded in {load_time:.1f}s ({param_count:.1f}M params)")
         
         # Quick test
@@ -50,8 +50,8 @@ export class RAGBridge {
         this.isReady = false;
       });
 
-      // Wait for server to be ready (max 30 seconds)
-      const maxWait = 30000;
+      // Wait for server to be ready (max 120 seconds - startup preloads and warms up models)
+      const maxWait = 120000;
       const checkInterval = 500;
       let waited = 0;
 
@@ -61,7 +61,7 @@ export class RAGBridge {
       }
 
       if (!this.isReady) {
-        throw new Error("RAG server failed to start within 30 seconds");
+        throw new Error("RAG server failed to start within 120 seconds");
       }
 
     } catch (error) {
@@ -6,20 +6,41 @@
 # - Logs activity to ingest.log
 # Run: source env/bin/activate && python ingest.py
 
-import os, glob, shutil, subprocess, logging
-from dotenv import load_dotenv
-from langchain.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.embeddings.openai import OpenAIEmbeddings
+import os, glob, shutil, subprocess, logging, hashlib, asyncio, random, json, time
+from collections import deque
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from tqdm import tqdm
 
-# Load env vars
-load_dotenv()
+from vectorstore import default_db_dir
 
-DATA_DIR = "data"
-PROCESSED_DIR = "processed"
-DB_DIR = "db"
-LOG_FILE = "ingest.log"
+# Heavy imports (langchain, chromadb, tiktoken, openai) live in the functions that use them,
+# so importing this module is cheap; .env is only loaded when run as a script
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()  # Load env vars (before the paths below, which they may override)
+
+# Paths are anchored to this file, not the working directory; AGENT_LAB_DOCS / AGENT_LAB_PROCESSED /
+# AGENT_LAB_DB override. With AGENT_LAB_DOCS set, processed/ goes inside that folder, never next to it
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get("AGENT_LAB_DOCS") or os.path.join(HERE, "data")
+PROCESSED_DIR = os.environ.get("AGENT_LAB_PROCESSED") or os.path.join(
+    DATA_DIR if os.environ.get("AGENT_LAB_DOCS") else HERE, "processed")
+DB_DIR = default_db_dir()
+LOG_FILE = os.path.join(HERE, "ingest.log")
+EMBED_CACHE_DIR = os.path.join(DB_DIR, "emb_cache")
+MANIFEST_FILE = os.path.join(DB_DIR, "ingested.json")  # file name -> {mtime, sha256} of its ingested version
+PAGES_PER_TASK = 50  # big PDFs are parsed as several page ranges in parallel
+EMBED_BATCH_SIZE = 512  # max chunks per embed_documents call
+EMBED_MAX_BATCH_TOKENS = 300_000  # OpenAI's per-request token cap for embeddings
+EMBED_MAX_INPUT_TOKENS = 8191  # OpenAI embedding models' per-input limit
+EMBED_CONCURRENCY = 8  # embedding requests in flight (OpenAI backend)
+EMBED_MAX_RETRIES = 6  # attempts per batch on 429 rate-limit errors
+WRITE_BATCH_SIZE = 5000  # rows per native Chroma upsert
+HASH_LOOKUP_BATCH = 500  # chunk hashes per Chroma "$in" lookup
+BATCH_API_MAX_INPUTS = 50_000  # embedding inputs per OpenAI Batch API job
+BATCH_API_POLL_SECS = 30
 
 # Configure logging
 logging.basicConfig(
@@ -43,14 +64,330 @@ def convert_md_to_pdf(md_file: str):
         print(f"❌ Failed to convert {md_file}: {e}")
         return None
 
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file's bytes (chunk IDs are derived from it)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest() -> dict:
+    """Previously ingested files ({} on the first run)."""
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict):
+    with open(MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+@lru_cache(maxsize=None)
+def get_splitter():
+    """Token-based splitter, built once per process (loading the tokenizer is the slow part)."""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from vectorstore import DEFAULT_LOCAL_EMBEDDING_MODEL, embeddings_backend
+
+    # Chunks are sized in tokens of the embedding model's tokenizer, so none is truncated at embed time
+    chunk_size = int(os.environ.get("INGEST_CHUNK_SIZE", 512))
+    chunk_overlap = int(os.environ.get("INGEST_CHUNK_OVERLAP", 64))
+    separators = ["\n\n", "\n", " ", ""]  # plain literals, no regex separators
+    if embeddings_backend() == "local":
+        # Sentence-transformer (WordPiece) models truncate past their max length; the splitter's
+        # token counts include [CLS]/[SEP], so capping at that length keeps every chunk whole
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(os.environ.get("RAG_EMBEDDING_MODEL", DEFAULT_LOCAL_EMBEDDING_MODEL))
+        return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer,
+            chunk_size=min(chunk_size, tokenizer.model_max_length),
+            chunk_overlap=chunk_overlap, separators=separators, is_separator_regex=False,
+        )
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=os.environ.get("INGEST_ENCODING", "cl100k_base"),  # OpenAI embedding models' tokenizer
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=separators, is_separator_regex=False,
+    )
+
+def page_count(pdf_path: str) -> int:
+    import fitz  # PyMuPDF
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+def load_and_split(pdf_path: str, start: int, stop: int):
+    """Load pages [start, stop) of one PDF and split them into chunks tagged with the source file
+    (runs in a worker process).
+
+    Returns (chunks, seconds spent), so a single slow PDF is visible in the output."""
+    import fitz  # PyMuPDF: MuPDF (C) extracts text far faster than pure-Python pypdf
+    from langchain_core.documents import Document
+
+    started = time.perf_counter()
+    splitter, source = get_splitter(), os.path.basename(pdf_path)
+    docs = []
+    with fitz.open(pdf_path) as pdf:
+        # Same metadata as langchain's PyMuPDFLoader, minus the per-page dict it builds for every page
+        file_meta = {k: v for k, v in pdf.metadata.items() if isinstance(v, (str, int))}
+        file_meta.update(file_path=pdf_path, total_pages=pdf.page_count, source=source)
+        for page in pdf.pages(start, stop):
+            # split_text + our own Documents: skips split_documents' per-chunk metadata deepcopy
+            for text in splitter.split_text(page.get_text()):
+                docs.append(Document(page_content=text, metadata={**file_meta, "page": page.number}))
+    return docs, time.perf_counter() - started
+
+def cached_embeddings(embeddings):
+    """Wrap the embedder in an on-disk cache keyed by chunk text + model name (unchanged chunks are never re-embedded)."""
+    from langchain.embeddings import CacheBackedEmbeddings
+    from langchain.storage import LocalFileStore
+
+    model = getattr(embeddings, "model", None) or embeddings.model_name  # OpenAIEmbeddings / HuggingFaceEmbeddings
+    store = LocalFileStore(EMBED_CACHE_DIR)
+    return CacheBackedEmbeddings.from_bytes_store(embeddings, store, namespace=model)
+
+@lru_cache(maxsize=None)
+def get_embeddings():
+    """Embedder for the whole run (one model load / HTTP client), behind the on-disk cache."""
+    from vectorstore import make_embeddings
+    return cached_embeddings(make_embeddings())
+
+def fit_to_input_limit(docs):
+    """Re-split chunks longer than EMBED_MAX_INPUT_TOKENS, so OpenAI never rejects a batch over one input."""
+    import tiktoken
+    from langchain.text_splitter import TokenTextSplitter
+    from langchain_core.documents import Document
+
+    enc = tiktoken.get_encoding("cl100k_base")  # tokenizer of OpenAI's embedding models
+    counts = [len(ids) for ids in enc.encode_batch([d.page_content for d in docs])]
+    if max(counts, default=0) <= EMBED_MAX_INPUT_TOKENS:
+        return docs
+
+    splitter = TokenTextSplitter(encoding_name="cl100k_base", chunk_size=EMBED_MAX_INPUT_TOKENS, chunk_overlap=0)
+    fitted = []
+    for d, n_tokens in zip(docs, counts):
+        if n_tokens <= EMBED_MAX_INPUT_TOKENS:
+            fitted.append(d)
+        else:
+            logging.warning(f"{d.metadata['source']}: re-split a {n_tokens}-token chunk for the embedding limit")
+            fitted.extend(Document(page_content=t, metadata=dict(d.metadata)) for t in splitter.split_text(d.page_content))
+    return fitted
+
+def make_batches(texts, max_tokens=None):
+    """Split texts into batches of at most EMBED_BATCH_SIZE texts (and max_tokens tokens, if given)."""
+    if max_tokens is None:
+        token_counts, max_tokens = [0] * len(texts), 0
+    else:
+        import tiktoken
+        enc = tiktoken.get_encoding("cl100k_base")  # tokenizer of OpenAI's embedding models
+        token_counts = [len(ids) for ids in enc.encode_batch(texts)]
+
+    batches, start, tokens = [], 0, 0
+    for i, n_tokens in enumerate(token_counts):
+        if i > start and (i - start >= EMBED_BATCH_SIZE or tokens + n_tokens > max_tokens):
+            batches.append(texts[start:i])
+            start, tokens = i, 0
+        tokens += n_tokens
+    if start < len(texts):
+        batches.append(texts[start:])
+    return batches
+
+async def embed_batch(embeddings, batch, sem, progress):
+    """Embed one batch under the semaphore, backing off exponentially (with jitter) on 429s."""
+    import openai
+
+    async with sem:
+        for attempt in range(EMBED_MAX_RETRIES):
+            try:
+                vectors = await embeddings.aembed_documents(batch)
+                progress.update(len(batch))
+                return vectors
+            except openai.RateLimitError:
+                if attempt == EMBED_MAX_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logging.warning(f"Embedding rate-limited, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+async def embed_all(embeddings, batches, concurrency, progress):
+    """Embed all batches with at most `concurrency` requests in flight, results in batch order."""
+    sem = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(embed_batch(embeddings, b, sem, progress) for b in batches))
+
+def embed_texts(embeddings, texts, loop):
+    """Embed texts batch by batch; OpenAI batches are token-capped and sent concurrently.
+
+    `loop` is the event loop of the whole ingest: the embedder's async HTTP pool is bound to the
+    loop it was first used on, so every file must be embedded on that same loop."""
+    from vectorstore import embeddings_backend
+
+    if embeddings_backend() == "openai":
+        batches, concurrency = make_batches(texts, EMBED_MAX_BATCH_TOKENS), EMBED_CONCURRENCY
+    else:
+        batches, concurrency = make_batches(texts), 1  # local model: one batch at a time
+    with tqdm(total=len(texts), desc="embed", unit="chunk", leave=False) as progress:
+        results = loop.run_until_complete(embed_all(embeddings, batches, concurrency, progress))
+    return [v for batch in results for v in batch]
+
+def submit_embedding_job(client, model, texts):
+    """Upload one Batch API job (one /v1/embeddings request per token-capped batch); returns (job id, batches)."""
+    batches = make_batches(texts, EMBED_MAX_BATCH_TOKENS)
+    lines = [
+        json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/embeddings",
+                    "body": {"model": model, "input": batch}})
+        for i, batch in enumerate(batches)
+    ]
+    upload = client.files.create(file=("embeddings.jsonl", "\n".join(lines).encode()), purpose="batch")
+    job = client.batches.create(input_file_id=upload.id, endpoint="/v1/embeddings", completion_window="24h")
+    return job.id, batches
+
+def wait_for_job(client, job_id):
+    """Poll a Batch API job until it completes (raises if it failed, expired or was cancelled)."""
+    while True:
+        job = client.batches.retrieve(job_id)
+        if job.status == "completed":
+            return job
+        if job.status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Embedding batch {job_id} {job.status}")
+        time.sleep(BATCH_API_POLL_SECS)
+
+def batch_api_embed(model, texts):
+    """Embed texts via OpenAI's Batch API: half the price of /v1/embeddings, results within 24h."""
+    from openai import OpenAI
+
+    client = OpenAI()
+    jobs = []
+    for i in range(0, len(texts), BATCH_API_MAX_INPUTS):
+        job_id, batches = submit_embedding_job(client, model, texts[i:i + BATCH_API_MAX_INPUTS])
+        jobs.append((job_id, batches))
+        msg = f"⏳ Submitted embedding batch {job_id} ({sum(map(len, batches))} chunks)"
+        print(msg)
+        logging.info(msg)
+
+    vectors = []
+    for job_id, batches in jobs:
+        job = wait_for_job(client, job_id)
+        results = {}
+        if job.output_file_id:
+            for line in client.files.content(job.output_file_id).text.splitlines():
+                row = json.loads(line)
+                if row["response"] and row["response"]["status_code"] == 200:
+                    data = sorted(row["response"]["body"]["data"], key=lambda d: d["index"])
+                    results[row["custom_id"]] = [d["embedding"] for d in data]
+        if len(results) < len(batches):
+            raise RuntimeError(f"Embedding batch {job_id}: {len(batches) - len(results)} requests failed")
+        for i in range(len(batches)):
+            vectors.extend(results[str(i)])
+    return vectors
+
+def batch_embed_texts(embeddings, texts):
+    """Batch API counterpart of embed_texts: only texts missing from the embedding cache are submitted."""
+    store = embeddings.document_embedding_store
+    missing = list({t: None for t, v in zip(texts, store.mget(texts)) if v is None})  # unique, in order
+    if missing:
+        store.mset(list(zip(missing, batch_api_embed(embeddings.underlying_embeddings.model, missing))))
+    return store.mget(texts)
+
+def write_chunks(db, ids, docs, vectors):
+    """Bulk-upsert one file's chunks on the native collection (deterministic IDs make re-runs overwrite, not duplicate)."""
+    texts = [d.page_content for d in docs]
+    step = min(WRITE_BATCH_SIZE, db._client.max_batch_size)  # Chroma rejects batches above its max
+    for i in range(0, len(ids), step):
+        db._collection.upsert(
+            ids=ids[i:i + step],
+            embeddings=vectors[i:i + step],
+            documents=texts[i:i + step],
+            metadatas=[d.metadata for d in docs[i:i + step]],
+        )
+
+def chunk_hash(text: str) -> str:
+    """First 16 bytes of the text's SHA-256 (hex); identical chunks share it."""
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+def release_file_chunks(db, name):
+    """Delete a file's chunks and drop it from other chunks' also_in; chunks other files share (also_in)
+    are handed over to the first of those files."""
+    from langchain_core.documents import Document
+
+    old = db._collection.get(where={"source": name}, include=["metadatas"])
+    handover = {chunk_id: meta for chunk_id, meta in zip(old["ids"], old["metadatas"]) if meta.get("also_in")}
+    shared = db._collection.get(ids=list(handover), include=["documents", "embeddings"]) if handover else None
+    if old["ids"]:
+        db._collection.delete(ids=old["ids"])
+
+    if shared:
+        # page, file_path and the PDF metadata describe this file's copy, and update() can only merge
+        # keys, so handed-over chunks are re-added with just the new owner's source/also_in
+        docs = []
+        for chunk_id, text in zip(shared["ids"], shared["documents"]):
+            others = handover[chunk_id]["also_in"].split(",")
+            meta = {"source": others[0], "also_in": ",".join(others[1:]), "chunk_hash": handover[chunk_id]["chunk_hash"]}
+            docs.append(Document(page_content=text, metadata=meta))
+        write_chunks(db, shared["ids"], docs, shared["embeddings"])
+
+    # Chroma can't match inside a string, so scan the chunks that list other sources
+    listed = db._collection.get(where={"also_in": {"$ne": ""}}, include=["metadatas"])
+    also_in = {}
+    for chunk_id, meta in zip(listed["ids"], listed["metadatas"]):
+        sources = meta["also_in"].split(",")
+        if name in sources:
+            sources.remove(name)
+            also_in[chunk_id] = ",".join(sources)
+    if also_in:
+        db._collection.update(ids=list(also_in), metadatas=[{"also_in": v} for v in also_in.values()])
+
+def dedupe_chunks(db, name, docs, vectors):
+    """Drop chunks whose text is already stored (or repeats within the file); stored copies from
+    other files get `name` added to their also_in metadata, so retrieval can list every source.
+
+    Returns the surviving (index, doc, vector) triples; the indexes keep chunk IDs stable."""
+    first = {}  # chunk hash -> index of its first occurrence in this file
+    for i, d in enumerate(docs):
+        d.metadata["chunk_hash"] = h = chunk_hash(d.page_content)
+        first.setdefault(h, i)
+
+    hashes, stored = list(first), {}
+    for i in range(0, len(hashes), HASH_LOOKUP_BATCH):
+        found = db._collection.get(where={"chunk_hash": {"$in": hashes[i:i + HASH_LOOKUP_BATCH]}}, include=["metadatas"])
+        for chunk_id, meta in zip(found["ids"], found["metadatas"]):
+            stored.setdefault(meta["chunk_hash"], (chunk_id, meta))
+
+    # Chroma metadata values must be scalars, so also_in is a comma-joined list of file names
+    also_in = {}
+    for chunk_id, meta in stored.values():
+        sources = [s for s in meta.get("also_in", "").split(",") if s]
+        if name not in sources:
+            also_in[chunk_id] = ",".join(sources + [name])
+    if also_in:
+        db._collection.update(ids=list(also_in), metadatas=[{"also_in": v} for v in also_in.values()])
+
+    if len(first) - len(stored) < len(docs):
+        logging.info(f"{name}: {len(docs) - len(first) + len(stored)} duplicate chunks not stored again")
+    return [(i, docs[i], vectors[i]) for h, i in first.items() if h not in stored]
+
+def store_file(db, manifest, pdf, digest, mtime, docs, vectors):
+    """Write one file's new chunks (replacing its previous version), checkpoint the manifest, move it to processed/.
+
+    Returns (destination path, number of chunks written)."""
+    name = os.path.basename(pdf)
+    if name in manifest:
+        # Changed file: drop the chunks of its previous version before adding the new ones
+        release_file_chunks(db, name)
+    kept = dedupe_chunks(db, name, docs, vectors)
+    write_chunks(db, [f"{digest}:{i}" for i, _, _ in kept], [d for _, d, _ in kept], [v for _, _, v in kept])
+
+    # Checkpoint: a crash later in the run keeps this file ingested
+    manifest[name] = {"mtime": mtime, "sha256": digest}
+    save_manifest(manifest)
+
+    dest = os.path.join(PROCESSED_DIR, name)
+    shutil.move(pdf, dest)
+    return dest, len(kept)
+
 def ingest_files():
     if not os.path.exists(DATA_DIR):
-        raise FileNotFoundError(f"No {DATA_DIR}/ folder found")
+        raise FileNotFoundError(f"No {DATA_DIR} folder found (create it, or set AGENT_LAB_DOCS to your documents folder)")
 
     os.makedirs(PROCESSED_DIR, exist_ok=True)
 
-    embeddings = OpenAIEmbeddings()
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+    embeddings = get_embeddings()
 
     # First handle Markdown → PDF conversion
     md_files = glob.glob(os.path.join(DATA_DIR, "*.md"))
@@ -62,41 +399,129 @@ def ingest_files():
     # Now process PDFs
     pdf_files = glob.glob(os.path.join(DATA_DIR, "*.pdf"))
     if not pdf_files:
-        msg = "⚠️ No new files found in data/"
+        msg = f"⚠️ No new files found in {DATA_DIR}"
         print(msg)
         logging.info(msg)
         return
 
-    all_docs = []
-    for pdf in pdf_files:
-        try:
-            print(f"📥 Loading {pdf}")
-            loader = PyPDFLoader(pdf)
-            pages = loader.load()
-            docs = splitter.split_documents(pages)
+    from vectorstore import embeddings_backend, open_vector_db
+    db = open_vector_db(embeddings, persist_directory=DB_DIR)
 
-            for d in docs:
-                d.metadata["source"] = os.path.basename(pdf)
+    # INGEST_MODE=batch: embed everything in OpenAI Batch API jobs after parsing, instead of file by file
+    openai_backend = embeddings_backend() == "openai"
+    batch_mode = os.environ.get("INGEST_MODE") == "batch"
+    if batch_mode and not openai_backend:
+        print("⚠️ INGEST_MODE=batch needs RAG_EMBEDDINGS=openai, embedding locally instead")
+        batch_mode = False
+    parsed = []
+    manifest = load_manifest()
 
-            all_docs.extend(docs)
+    # Parse + split PDFs in parallel processes (PDF parsing and splitting are CPU-bound), in page ranges
+    # so one huge PDF is spread over all workers (MuPDF is not thread-safe, so no threads within a file).
+    # Each file is embedded and written once all its ranges are in, and only load_workers files are
+    # parsed at a time (the next one is submitted as one finishes), so memory holds few files' chunks
+    # Build the splitter before the pool: forked workers inherit it, spawned ones build it once in the initializer
+    get_splitter()
+    total_chunks = 0
+    load_workers = int(os.environ.get("INGEST_WORKERS", max(1, (os.cpu_count() or 2) - 1)))  # PDF parsing processes
+    with ProcessPoolExecutor(max_workers=load_workers, initializer=get_splitter) as pool, \
+            closing(asyncio.new_event_loop()) as loop:
+        futures = {}
+        pending = deque()  # (pdf, digest, mtime, range starts) waiting for a parse slot
+        files = {}  # pdf -> (digest, mtime, per-range results) for files being parsed
+        for pdf in pdf_files:
+            name, mtime = os.path.basename(pdf), os.path.getmtime(pdf)
+            entry = manifest.get(name)
 
-            dest = os.path.join(PROCESSED_DIR, os.path.basename(pdf))
-            shutil.move(pdf, dest)
+            # Same mtime → unchanged without reading the file; otherwise compare content hashes.
+            # Content already stored under another name is not skipped: dedupe_chunks adds this name to
+            # those chunks' also_in (and store_file to the manifest); the embedding cache keeps it cheap
+            digest = None if entry and entry["mtime"] == mtime else file_sha256(pdf)
+            if digest is None or (entry and entry["sha256"] == digest):
+                entry["mtime"] = mtime
+                dest = os.path.join(PROCESSED_DIR, name)
+                shutil.move(pdf, dest)
+                msg = f"⏭️ Skipped {pdf} (unchanged since last ingest) → moved to {dest}"
+                print(msg)
+                logging.info(msg)
+                continue
 
-            msg = f"✅ Ingested {pdf} ({len(docs)} chunks) → moved to {dest}"
-            print(msg)
-            logging.info(msg)
+            try:
+                starts = range(0, page_count(pdf), PAGES_PER_TASK) or [0]
+            except Exception as e:
+                msg = f"❌ Failed to ingest {pdf}: {e}"
+                print(msg)
+                logging.error(msg)
+                continue
+
+            pending.append((pdf, digest, mtime, starts))
+
+        progress = tqdm(total=len(pending), desc="PDFs", unit="pdf", disable=not pending)
+        while pending or futures:
+            while pending and len(files) < load_workers:
+                pdf, digest, mtime, starts = pending.popleft()
+                tqdm.write(f"📥 Loading {pdf}")
+                files[pdf] = (digest, mtime, [None] * len(starts))
+                for part, start in enumerate(starts):
+                    futures[pool.submit(load_and_split, pdf, start, start + PAGES_PER_TASK)] = (pdf, part)
+
+            future = next(iter(wait(futures, return_when=FIRST_COMPLETED).done))
+            pdf, part = futures.pop(future)
+            if pdf not in files:
+                continue  # another page range of this file already failed
+            digest, mtime, parts = files[pdf]
+            try:
+                parts[part] = future.result()
+                if None in parts:
+                    continue  # wait for the file's remaining page ranges
+                del files[pdf]
+                progress.update(1)
 
-        except Exception as e:
-            msg = f"❌ Failed to ingest {pdf}: {e}"
+                docs = [d for part_docs, _ in parts for d in part_docs]
+                parse_secs = sum(secs for _, secs in parts)  # CPU time across workers
+                if openai_backend:
+                    docs = fit_to_input_limit(docs)
+                if batch_mode:
+                    parsed.append((pdf, digest, mtime, docs))
+                    continue
+
+                started = time.perf_counter()
+                vectors = embed_texts(embeddings, [d.page_content for d in docs], loop)
+                dest, written = store_file(db, manifest, pdf, digest, mtime, docs, vectors)
+                total_chunks += written
+
+                secs = f"parse {parse_secs:.1f}s, embed+write {time.perf_counter() - started:.1f}s"
+                msg = f"✅ Ingested {pdf} ({written} new chunks of {len(docs)}; {secs}) → moved to {dest}"
+                tqdm.write(msg)  # print() would break the progress bar
+                logging.info(msg)
+
+            except Exception as e:
+                if files.pop(pdf, None):
+                    progress.update(1)
+                msg = f"❌ Failed to ingest {pdf}: {e}"
+                tqdm.write(msg)
+                logging.error(msg)
+        progress.close()
+
+    if parsed:
+        vectors = batch_embed_texts(embeddings, [d.page_content for *_, docs in parsed for d in docs])
+        offset = 0
+        for pdf, digest, mtime, docs in parsed:
+            file_vectors = vectors[offset:offset + len(docs)]
+            offset += len(docs)
+            dest, written = store_file(db, manifest, pdf, digest, mtime, docs, file_vectors)
+            total_chunks += written
+
+            msg = f"✅ Ingested {pdf} ({written} new chunks of {len(docs)}) → moved to {dest}"
             print(msg)
-            logging.error(msg)
+            logging.info(msg)
 
-    if all_docs:
-        db = Chroma.from_documents(all_docs, embeddings, persist_directory=DB_DIR)
+    if total_chunks:
         db.persist()
-        print(f"🎉 Ingestion complete: {len(all_docs)} chunks into {DB_DIR}/")
-        logging.info(f"Ingestion complete: {len(all_docs)} chunks into {DB_DIR}/")
+        print(f"🎉 Ingestion complete: {total_chunks} chunks into {DB_DIR}/")
+        logging.info(f"Ingestion complete: {total_chunks} chunks into {DB_DIR}/")
+
+    save_manifest(manifest)
 
 if __name__ == "__main__":
     logging.info("----- Ingest Run Started -----")
@@ -0,0 +1,71 @@
+# rag/vectorstore.py (v1.0)
+# 🗂️ Shared Chroma vector store for api.py + ingest.py
+# - One place for persist dir, collection name and HNSW index params
+# - Index params are only applied when the collection is first created
+# - Embedder factory: local sentence-transformer (default) or OpenAI
+
+import os
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]  # repo root, whatever the working directory
+COLLECTION_NAME = "langchain"  # langchain's default, so existing stores keep working
+
+# HNSW (approximate nearest neighbour) index params
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 16,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+DEFAULT_LOCAL_EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"  # 384-dim
+
+def embeddings_backend() -> str:
+    """Which embedder make_embeddings() builds: "local" (default) or "openai"."""
+    return os.getenv("RAG_EMBEDDINGS", "local")
+
+def default_db_dir() -> str:
+    """$AGENT_LAB_DB, else <repo>/server/db (read per call, so a .env loaded after import applies)."""
+    return os.environ.get("AGENT_LAB_DB") or str(ROOT / "server" / "db")
+
+def make_embeddings(**openai_kwargs):
+    """Build the embedder (ingest + queries must use the same one; re-ingest after switching)."""
+    if embeddings_backend() == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(**openai_kwargs)
+
+    # Local model: no network round-trip per query or per chunk
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"  # Apple silicon GPU
+    else:
+        device = "cpu"
+    return HuggingFaceEmbeddings(
+        model_name=os.getenv("RAG_EMBEDDING_MODEL", DEFAULT_LOCAL_EMBEDDING_MODEL),
+        model_kwargs={"device": device},
+        encode_kwargs={"batch_size": 64, "normalize_embeddings": True},
+    )
+
+def open_vector_db(embeddings, persist_directory: str = None):
+    """Open (or create) the HNSW-indexed Chroma collection."""
+    import chromadb
+    from langchain_community.vectorstores import Chroma
+
+    persist_directory = persist_directory or default_db_dir()
+    client = chromadb.PersistentClient(path=persist_directory)
+
+    # Chroma replaces collection metadata wholesale, so never pass it for an
+    # existing collection (its index was built with whatever params it has)
+    existing = {c.name for c in client.list_collections()}
+    metadata = None if COLLECTION_NAME in existing else HNSW_METADATA
+
+    return Chroma(
+        client=client,
+        persist_directory=persist_directory,
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+        collection_metadata=metadata,
+    )